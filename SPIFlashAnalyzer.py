@@ -3,8 +3,6 @@
 
 from saleae.analyzers import HighLevelAnalyzer, AnalyzerFrame, NumberSetting, ChoicesSetting
 
-import struct
-
 # value is dummy bytes
 QUAD_CONTINUE_COMMANDS = {
     0x6b: 4,
@@ -44,15 +42,131 @@ CONTROL_COMMANDS = {
     EX4B: "Exit 4 Byte Address"
 }
 
-class FakeFrame:
-    def __init__(self, t, time=None):
-        self.type = t
-        self.start_time = time
-        self.end_time = time
-        self.data = {}
+def _command_table(commands):
+    '''
+    Expand a command dict into a list indexed by the command byte. Unknown commands are None.
+    '''
+    table = [None] * 256
+    for command, value in commands.items():
+        table[command] = value
+    return table
+
+QUAD_DUMMY_TABLE = _command_table(QUAD_CONTINUE_COMMANDS)
+DUAL_DUMMY_TABLE = _command_table(DUAL_CONTINUE_COMMANDS)
+DATA_CMD_TABLE = _command_table(DATA_COMMANDS)
+CTRL_CMD_TABLE = _command_table(CONTROL_COMMANDS)
+
+# Frame types shown for each decode level. None shows everything.
+DECODE_LEVEL_TYPES = {
+    'Everything': None,
+    'Only Data': frozenset(('data', 'data_command', 'error')),
+    'Only Errors': frozenset(('error',)),
+    'Only Control': frozenset(('control_command',)),
+}
+
+class ParallelDecoder:
+    '''
+    Per clock state machine for Simple Parallel input. `step` returns the
+    MOSI byte when a byte completes, otherwise None. Only MOSI is decoded
+    because MISO is never shown.
+
+    Every transaction starts in single bit SPI mode. Once the command byte
+    selects quad or dual I/O, `step` is rebound to the matching method for
+    the rest of the transaction so no per clock mode checks are needed.
+    '''
+    __slots__ = ('header_bytes', 'clock_count', 'mosi_out', 'quad_data',
+                 'continuous', 'dummy', 'command', 'step')
+
+    def __init__(self):
+        self.header_bytes = 4
+        self.clock_count = 0
+        self.mosi_out = 0
+        self.quad_data = 0
+        self.continuous = False
+        self.dummy = 0
+        self.command = 0
+        self.step = self._step_spi
+
+    def start_transaction(self):
+        self.clock_count = 0
+        if not self.continuous:
+            self.command = 0
+            self.dummy = 0
+            self.step = self._step_spi
+
+            # Zero the data buffers to prevent issues with odd lengths of transactions if QSPI mode isn't detected properly.
+            self.mosi_out = 0
+            self.quad_data = 0
+            return None
+        # Continuous reads skip the command byte so replay the previous one.
+        self.clock_count = 8
+        return self.command
+
+    def _step_spi(self, data):
+        result = None
+        clock_count = self.clock_count
+        mosi_out = self.mosi_out << 1 | (data & 0x1)
+        if clock_count & 0x7 == 0x7:
+            if clock_count == 7:
+                self.command = mosi_out
+                quad_dummy = QUAD_DUMMY_TABLE[mosi_out]
+                dual_dummy = DUAL_DUMMY_TABLE[mosi_out]
+                if quad_dummy is not None:
+                    self.step = self._step_quad
+                    self.dummy = quad_dummy
+                elif dual_dummy is not None:
+                    self.step = self._step_dual
+                    self.dummy = dual_dummy
+
+            result = mosi_out
+            mosi_out = 0
+        self.mosi_out = mosi_out
+        self.clock_count = clock_count + 1
+        return result
+
+    def _step_quad(self, data):
+        result = None
+        clock_count = self.clock_count
+        self.quad_data = self.quad_data << 4 | (data & 0xf)
+        if clock_count & 0x1:
+            # Quad and dual data starts after the 8 clock command byte.
+            result = self._wide_byte(1 + ((clock_count - 8) >> 1))
+        self.clock_count = clock_count + 1
+        return result
+
+    def _step_dual(self, data):
+        result = None
+        clock_count = self.clock_count
+        self.quad_data = self.quad_data << 2 | (data & 0x3)
+        if clock_count & 0x3 == 0x3:
+            result = self._wide_byte(1 + ((clock_count - 8) >> 2))
+        self.clock_count = clock_count + 1
+        return result
+
+    def _wide_byte(self, byte_count):
+        result = None
+        quad_data = self.quad_data
+        if byte_count == 4:
+            # At least some SPI flashes use 'nibbles are complements' to enter
+            # continous read mode (or ST calls 'send instruction only'). So this
+            # should check for e.g., 0xa5. Unclear if some flashes don't do this
+            # and just use any pattern in high nibble, so check for 0xA in high
+            # nibble which seems to work in practice. If you aren't seeing
+            # continous reads working look here first.
+            self.continuous = (quad_data & 0xf0) == 0xa0
+        elif byte_count < self.header_bytes:
+            result = quad_data
+        else:
+            # Only the byte count matters after the header.
+            result = 0
+        self.quad_data = 0
+        return result
 
 # High level analyzers must subclass the HighLevelAnalyzer class.
 class SPIFlash(HighLevelAnalyzer):
+    # Set to True to log the first result that arrives outside of a transaction.
+    _DEBUG = False
+
     # List of settings that a user can set for this High Level Analyzer.
     min_address = NumberSetting(min_value=0)
     max_address = NumberSetting(min_value=0)
@@ -81,15 +195,18 @@ class SPIFlash(HighLevelAnalyzer):
         Settings can be accessed using the same name used above.
         '''
         self._start_time = None
-        self._address_bytes = 3
-        self._address_format = "{:0" + str(2*int(self._address_bytes)) + "x}"
+        self._parallel = ParallelDecoder()
+        self._set_address_bytes(3)
         self._min_address = int(self.min_address)
         self._max_address = None
         if self.max_address:
             self._max_address = int(self.max_address)
+        self._allowed_types = DECODE_LEVEL_TYPES[self.decode_level]
 
-        self._miso_data = None
-        self._mosi_data = None
+        # The command and address bytes are shifted into an int as they arrive.
+        # The rest of the transaction is only counted. None outside a transaction.
+        self._mosi_bits = 0
+        self._mosi_len = None
         self._empty_result_count = 0
 
         # These are for quad decoding. The input will be a SimpleParallel analyzer
@@ -97,18 +214,25 @@ class SPIFlash(HighLevelAnalyzer):
         self._last_cs = 1
         self._last_time = None
         self._transaction = 0
-        self._clock_count = 0
-        self._mosi_out = 0
-        self._miso_in = 0
-        self._quad_data = 0
-        self._dual_start = None
-        self._quad_start = None
-        self._continuous = False
-        self._dummy = 0
 
-        self._fastest_cs = 2000000
+        # CS is assumed high for gaps longer than 6 times the fastest clock.
+        self._cs_threshold_ns = 2_000_000
 
 
+    def _set_address_bytes(self, address_bytes):
+        self._address_bytes = address_bytes
+        # The address follows the command byte.
+        self._header_bytes = 1 + address_bytes
+        self._addr_shift = 8 * address_bytes
+        self._addr_mask = (1 << self._addr_shift) - 1
+        self._addr_hex_width = 2 * address_bytes
+        self._parallel.header_bytes = self._header_bytes
+
+    def _in_address_range(self, address):
+        if address < self._min_address:
+            return False
+        return self._max_address is None or address <= self._max_address
+
     def decode(self, frame: AnalyzerFrame):
         '''
         Process a frame from the input analyzer, and optionally return a single `AnalyzerFrame` or a list of `AnalyzerFrame`s.
@@ -117,195 +241,146 @@ class SPIFlash(HighLevelAnalyzer):
         '''
 
         # Support getting data from a Simple Parallel and converting it.
-        frames = []
         if frame.type == "data":
             reset_cs = False
-            data = frame.data["data"]
-            if "index" in frame.data:
-                reset_cs = frame.data["index"] == 0
-                cs = 0
+            sample_data = frame.data
+            data = sample_data["data"]
+            sample_time = frame.start_time
+            last_time = self._last_time
+            parallel = self._parallel
+            if "index" in sample_data:
+                reset_cs = sample_data["index"] == 0
             else:
-                cs = data >> 15
-                if self._last_time:
-                    diff = frame.start_time - self._last_time
+                # TODO: We could output clock counts when cs is high.
+                if data & 0x8000:
+                    # Nothing to decode while CS (D15) is high.
+                    self._last_time = sample_time
+                    return None
+                if last_time:
+                    diff_ns = round(float(sample_time - last_time) * 1_000_000_000)
+                    gap_ns = diff_ns * 6
+                    if gap_ns < self._cs_threshold_ns:
+                        self._cs_threshold_ns = gap_ns
+                    reset_cs = diff_ns > self._cs_threshold_ns
                 else:
-                    diff = self._fastest_cs
-                diff = float(diff * 1_000_000_000)
-
-                self._fastest_cs = min(diff * 6, self._fastest_cs)
-                reset_cs = diff > self._fastest_cs and cs == 0
+                    # The first sample always starts a transaction.
+                    reset_cs = True
 
+            output = None
             if reset_cs:
+                # Close the previous transaction before the decoder state is
+                # reset so its data count uses its own dummy bytes.
                 if self._transaction > 0:
-                    frames.append(FakeFrame("disable", self._last_time))
+                    output = self._on_disable(last_time, last_time)
 
-                frames.append(FakeFrame("enable", frame.start_time))
+                self._on_enable(sample_time)
 
                 self._transaction += 1
-                self._clock_count = 0
-                if not self._continuous:
-                    self._command = 0
-                    self._quad_start = None
-                    self._dual_start = None
-                    self._dummy = 0
-
-                    # Zero the data buffers to prevent issues with odd lengths of transactions if QSPI mode isn't detected properly.
-                    self._mosi_out = 0
-                    self._miso_in = 0
-                    self._quad_data = 0
-                else:
-                    self._clock_count = 8
-                    f = FakeFrame("result")
-                    f.data["mosi"] = [self._command]
-                    f.data["miso"] = [0]
-                    frames.append(f)
+                result = parallel.start_transaction()
+                if result is not None:
+                    our_frame = self._on_result(sample_time, sample_time, result)
+                    if our_frame is not None:
+                        output = our_frame
 
-            self._last_time = frame.start_time
+            self._last_time = sample_time
 
-            # TODO: We could output clock counts when cs is high.
-            if cs == 1:
-                return None
+            result = parallel.step(data)
+            if result is not None:
+                our_frame = self._on_result(sample_time, sample_time, result)
+                if our_frame is not None:
+                    output = our_frame
+            return output
 
-            if (self._quad_start is None or self._clock_count < self._quad_start) and (self._dual_start is None or self._clock_count < self._dual_start):
-                self._mosi_out = self._mosi_out << 1 | (data & 0x1)
-                self._miso_in = self._miso_in << 1 | ((data >> 1) & 0x1)
-                if self._clock_count % 8 == 7:
-                    if self._clock_count == 7:
-                        self._command = self._mosi_out
-                        if self._command in QUAD_CONTINUE_COMMANDS:
-                            self._quad_start = 8
-                            self._dummy = QUAD_CONTINUE_COMMANDS[self._command]
-                        elif self._command in DUAL_CONTINUE_COMMANDS:
-                            self._dual_start = 8
-                            self._dummy = DUAL_CONTINUE_COMMANDS[self._command]
-
-                    f = FakeFrame("result", frame.start_time)
-                    f.data["mosi"] = [self._mosi_out]
-                    f.data["miso"] = [self._miso_in]
-                    frames.append(f)
-                    self._mosi_out = 0
-                    self._miso_in = 0
-            else:
-                if self._dual_start is not None:
-                    bits = 2
-                    start = self._dual_start
-                else:
-                    bits = 4
-                    start = self._quad_start
-                divider = 8 // bits
-                byte_count = start // 8 + (self._clock_count - start) // divider
-                self._quad_data = (self._quad_data << bits | (data & ((1 << bits) - 1)))
-                if self._clock_count % divider == divider - 1:
-                    f = FakeFrame("result", frame.start_time)
-                    if (self._command in QUAD_CONTINUE_COMMANDS or self._command in DUAL_CONTINUE_COMMANDS) and byte_count == 4:
-                        # At least some SPI flashes use 'nibbles are complements' to enter
-                        # continous read mode (or ST calls 'send instruction only'). So this
-                        # should check for e.g., 0xa5. Unclear if some flashes don't do this
-                        # and just use any pattern in high nibble, so check for 0xA in high
-                        # nibble which seems to work in practice. If you aren't seeing
-                        # continous reads working look here first.
-                        self._continuous = (self._quad_data & 0xf0) == 0xa0
-                    elif byte_count < 1 + self._address_bytes:
-                        f.data["mosi"] = [self._quad_data]
-                        f.data["miso"] = [0]
-                        frames.append(f)
-                    else:
-                        f.data["mosi"] = [0]
-                        f.data["miso"] = [self._quad_data]
-                        frames.append(f)
-                    self._quad_data = 0
-
-            self._clock_count += 1
+        if frame.type == "result":
+            # The SPI analyzer packs wider transfers into one result.
+            output = None
+            for mosi_byte in frame.data["mosi"]:
+                our_frame = self._on_result(frame.start_time, frame.end_time, mosi_byte)
+                if our_frame is not None:
+                    output = our_frame
+            return output
+        if frame.type == "enable":
+            self._on_enable(frame.start_time)
+        elif frame.type == "disable":
+            return self._on_disable(frame.start_time, frame.end_time)
+        return None
+
+    def _on_enable(self, start_time):
+        self._start_time = start_time
+        self._mosi_bits = 0
+        self._mosi_len = 0
+
+    def _on_result(self, start_time, end_time, mosi_byte):
+        mosi_len = self._mosi_len
+        if mosi_len is None:
+            if self._DEBUG and self._empty_result_count == 0:
+                print("result outside of a transaction at", start_time)
+            self._empty_result_count += 1
+            return None
+        header_bytes = self._header_bytes
+        if mosi_len >= header_bytes:
+            self._mosi_len = mosi_len + 1
+            return None
+        mosi_bits = self._mosi_bits << 8 | mosi_byte
+        mosi_len += 1
+        self._mosi_bits = mosi_bits
+        self._mosi_len = mosi_len
+        if mosi_len < header_bytes:
+            return None
+        # Output data commands and their address immediately.
+        command_name = DATA_CMD_TABLE[mosi_bits >> self._addr_shift]
+        if command_name is None:
+            return None
+        frame_address = mosi_bits & self._addr_mask
+        if not self._in_address_range(frame_address):
+            return None
+        return self._emit("data_command", start_time, end_time,
+                          {"command": command_name,
+                           "address": f"{frame_address:0{self._addr_hex_width}x}"})
+
+    def _on_disable(self, start_time, end_time):
+        mosi_len = self._mosi_len
+        if not mosi_len:
+            return None
+        # Reset on disable
+        self._mosi_len = None
+        header_bytes = self._header_bytes
+        mosi_bits = self._mosi_bits
+        if mosi_len < header_bytes:
+            command = mosi_bits >> (8 * (mosi_len - 1))
         else:
-            print("non data!")
-            frames = [frame]
-
-        output = None
-        for fake_frame in frames:
-            frame_type = None
-            frame_data = {}
-            if fake_frame.type == "enable":
-                self._start_time = fake_frame.start_time
-                self._miso_data = bytearray()
-                self._mosi_data = bytearray()
-            elif fake_frame.type == "result":
-                if self._miso_data is None or self._mosi_data is None:
-                    if self._empty_result_count == 0:
-                        print(fake_frame)
-                    self._empty_result_count += 1
-                    continue
-                self._miso_data.extend(fake_frame.data["miso"])
-                self._mosi_data.extend(fake_frame.data["mosi"])
-                command = self._mosi_data[0]
-                # Output data commands and their address immediately.
-                if len(self._mosi_data) == 1 + self._address_bytes and command in DATA_COMMANDS:
-                    frame_type = "data_command"
-                    frame_data["command"] = DATA_COMMANDS[command]
-                    frame_address = 0
-                    for i in range(int(self._address_bytes)):
-                        frame_address <<= 8
-                        frame_address += self._mosi_data[1+i]
-                    if self.min_address > 0 and frame_address < self._min_address:
-                        frame_type = None
-                    elif self.max_address and frame_address > self.max_address:
-                        frame_type = None
-                    else:
-                        frame_data["address"] = self._address_format.format(frame_address)
-
-            elif fake_frame.type == "disable":
-                if not self._miso_data or not self._mosi_data:
-                    continue
-                command = self._mosi_data[0]
-                frame_data["command"] = command
-                if command in DATA_COMMANDS:
-                    if len(self._mosi_data) < 1 + int(self._address_bytes):
-                        frame_type = "error"
-                    else:
-                        frame_type = "data"
-                        frame_address = 0
-                        for i in range(int(self._address_bytes)):
-                            frame_address <<= 8
-                            frame_address += self._mosi_data[1+i]
-                        if self.min_address > 0 and frame_address < self._min_address:
-                            frame_type = None
-                        elif self.max_address and frame_address > self.max_address:
-                            frame_type = None
-                        else:
-                            # -1 for command
-                            num_data_bytes = len(self._mosi_data) - self._address_bytes - 1 - self._dummy
-                            print(num_data_bytes)
-                            frame_data["num_bytes"] = num_data_bytes
-                            frame_data["address_end"] = self._address_format.format(frame_address + num_data_bytes)
-                else:
-                    if command in CONTROL_COMMANDS:
-                        frame_data["command"] = CONTROL_COMMANDS[command]
-                    else:
-                        # Unrecognized commands are printed in hexadecimal
-                        frame_data["command"] = ''.join([ '0x', hex(command).upper()[2:] ])
-                    if command == EN4B:
-                        self._address_bytes = 4
-                        self._address_format = "{:0" + str(2*int(self._address_bytes)) + "x}"
-                    elif command == EX4B:
-                        self._address_bytes = 3
-                        self._address_format = "{:0" + str(2*int(self._address_bytes)) + "x}"
-                    frame_type = "control_command"
-
-                # Reset on disable
-                self._miso_data = None
-                self._mosi_data = None
-            our_frame = None
-            if frame_type:
-                our_frame = AnalyzerFrame(frame_type,
-                                          self._start_time,
-                                          fake_frame.end_time,
-                                          frame_data)
-                self._start_time = fake_frame.start_time
-            if self.decode_level == 'Only Data' and frame_type == "control_command":
-                continue
-            if self.decode_level == 'Only Errors' and frame_type != "error":
-                continue
-            if self.decode_level == "Only Control" and frame_type != "control_command":
-                continue
-            if our_frame:
-                output = our_frame
-        return output
+            command = mosi_bits >> self._addr_shift
+        if DATA_CMD_TABLE[command] is not None:
+            if mosi_len < header_bytes:
+                return self._emit("error", start_time, end_time, {"command": command})
+            frame_address = mosi_bits & self._addr_mask
+            if not self._in_address_range(frame_address):
+                return None
+            # header_bytes also counts the command byte
+            # Transactions that end before their dummy bytes have no data.
+            num_data_bytes = max(0, mosi_len - header_bytes - self._parallel.dummy)
+            return self._emit("data", start_time, end_time,
+                              {"command": command,
+                               "num_bytes": num_data_bytes,
+                               "address_end": f"{frame_address + num_data_bytes:0{self._addr_hex_width}x}"})
+
+        command_name = CTRL_CMD_TABLE[command]
+        if command_name is None:
+            # Unrecognized commands are printed in hexadecimal
+            command_name = f"0x{command:02X}"
+        if command == EN4B:
+            self._set_address_bytes(4)
+        elif command == EX4B:
+            self._set_address_bytes(3)
+        return self._emit("control_command", start_time, end_time, {"command": command_name})
+
+    def _emit(self, frame_type, start_time, end_time, frame_data):
+        '''
+        Create a frame spanning from the previous one to end_time and return
+        it if the decode level shows this type.
+        '''
+        our_frame = AnalyzerFrame(frame_type, self._start_time, end_time, frame_data)
+        self._start_time = start_time
+        if self._allowed_types is not None and frame_type not in self._allowed_types:
+            return None
+        return our_frame